@@ -1,15 +1,26 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+from __future__ import annotations
+
 import argparse
+import asyncio
+import mmap
 import socket
 import os
+import queue
 import sys
 import struct
 import time
 import random
+import re
+import selectors
+import stat
 import traceback
 import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 # NOTE: Do NOT import other libraries!
 
@@ -17,6 +28,463 @@ UDP_CODE = socket.IPPROTO_UDP
 ICMP_ECHO_REQUEST = 8
 MAX_DATA_RECV = 65535
 MAX_TTL = 30
+MAX_DNS_WORKERS = 16
+MAX_WEB_WORKERS = 64
+MAX_PROXY_WORKERS = (os.cpu_count() or 1) * 32
+
+# Limits on the number of responses the proxy caches and their total size
+PROXY_CACHE_ENTRIES = 1024
+PROXY_CACHE_BYTES = 256 * 1024 * 1024
+# Number of independently locked parts the proxy cache is split into (a power
+# of two), and the total width of their frequency sketches
+PROXY_CACHE_SHARDS = 16
+PROXY_SKETCH_WIDTH = 2048
+# Smallest response the proxy caches in an anonymous memory file, which hits
+# send with sendfile (smaller ones are kept as bytes and sent from memory)
+MIN_MEMFD_RESPONSE = 64 * 1024
+# Most responses cached in memory files at once. Each holds a file descriptor
+# for as long as it is cached, so they may use at most a quarter of the
+# descriptor limit, leaving the rest for connections (further responses are
+# kept as bytes)
+MAX_MEMFD_RESPONSES = (
+    min(256, os.sysconf("SC_OPEN_MAX") // 4) if hasattr(os, "memfd_create") else 0
+)
+
+# Size of the buffers the proxy receives upstream responses into
+CHUNK_SIZE = 65536
+
+# Seconds a client connection may wait between requests, or stall part way
+# through one, before the server closes it
+CLIENT_TIMEOUT = 15
+
+# Largest request body either server accepts (bodies are held in memory);
+# larger requests are answered with 413 and the connection closed
+MAX_REQUEST_BODY = 1024 * 1024
+
+# Send and receive buffer size of server sockets (inherited by the connections
+# they accept)
+SOCKET_BUFFER_SIZE = 1 << 20
+
+# Number of files the web server keeps memory-mapped, and the largest file it
+# maps (larger ones are streamed with sendfile). Before Python 3.13 each map
+# keeps a duplicate of its file's descriptor open for as long as it is cached,
+# so the maps may use at most a quarter of the descriptor limit, leaving the
+# rest for connections. From 3.13 maps are made without one (trackfd=False),
+# which only gives up mmap.size() and resize(), neither of which is used
+_MMAP_KWARGS = (
+    {"trackfd": False} if sys.version_info >= (3, 13) and os.name == "posix" else {}
+)
+WEB_CACHE_ENTRIES = (
+    min(256, os.sysconf("SC_OPEN_MAX") // 4)
+    if not _MMAP_KWARGS and hasattr(os, "sysconf")
+    else 256
+)
+MAX_CACHED_FILE_SIZE = 16 * 1024 * 1024
+
+# Seconds the proxy caches successful responses without a Cache-Control
+# max-age, and error responses
+PROXY_CACHE_TTL = 60
+PROXY_ERROR_TTL = 10
+
+# Idle keep-alive connections the proxy keeps open to each web server
+MAX_SERVER_CONNECTIONS = 32
+
+# Delay between launching traceroute probes (seconds)
+SEND_LAUNCH_INTERVAL = 0.005
+# UDP destination port of the first traceroute probe
+UDP_BASE_PORT = 33440
+
+# IPv4, ICMP and UDP header layouts, compiled once
+_IP_HDR = struct.Struct("!BBHHHBBH4s4s")
+_ICMP_HDR = struct.Struct("!BBHHH")
+_UDP_HDR = struct.Struct("!HHHH")
+
+# Payload of an ICMP ping probe, and the sum of its 16-bit words
+_PAYLOAD = b"A" * 48
+_PAYLOAD_SUM = sum(struct.unpack("!24H", _PAYLOAD))
+
+# Payload of a UDP traceroute probe, built once rather than on every probe
+_PROBE_PAYLOAD = b"0" * 52
+
+# Probe payloads of other sizes, built on first use: {(length, byte): payload}
+_PAYLOAD_CACHE = {
+    (len(_PAYLOAD), b"A"): _PAYLOAD,
+    (len(_PROBE_PAYLOAD), b"0"): _PROBE_PAYLOAD,
+}
+
+# DNS caches shared by all threads: {hostname: (ip, expiry)} for forward
+# lookups and {ip: (hostname, expiry)} for reverse lookups, where failed
+# reverse lookups are cached as None for a shorter time
+_a_cache = {}
+_ptr_cache = {}
+_dns_cache_lock = threading.Lock()
+_A_TTL = 300
+_PTR_TTL = 900
+_PTR_NEGATIVE_TTL = 300
+
+# max-age directive of a lower-cased Cache-Control header
+_MAX_AGE = re.compile(rb"max-age\s*=\s*(\d+)")
+
+# Statuses of final responses the proxy caches. The cache key ignores Range
+# and conditional request headers, so partial (206) and not modified (304)
+# responses, which only answer those, are never cached
+_CACHEABLE_STATUSES = frozenset((200, 203, 204, 300, 301, 308, 404, 405, 410, 414))
+
+# Request methods the proxy may send to the server again if a reused connection
+# turns out to have been closed, as repeating them has no further effect
+_IDEMPOTENT_METHODS = (b"GET ", b"HEAD ", b"PUT ", b"DELETE ", b"OPTIONS ", b"TRACE ")
+
+# Response to a request whose body is larger than MAX_REQUEST_BODY
+_TOO_LARGE_RESPONSE = (
+    b"HTTP/1.1 413 Content Too Large\r\nContent-Length: 0\r\n"
+    b"Connection: close\r\n\r\n"
+)
+
+# Response the web server sends for a missing file, built once
+_NOT_FOUND_BODY = b"<html><head></head><body><h1>404 Not Found</h1></body></html>\r\n"
+_NOT_FOUND_RESPONSE = (
+    b"HTTP/1.1 404 Not Found\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+    % len(_NOT_FOUND_BODY)
+    + _NOT_FOUND_BODY
+)
+
+# Per-thread buffer that client requests are received into
+_tls = threading.local()
+
+# Buffers that the proxy receives upstream responses into, returned for reuse
+# once a response has been relayed
+_chunk_pool: queue.SimpleQueue[memoryview] = queue.SimpleQueue()
+
+
+# Return this thread's request buffer and a view of it, allocated on first use
+def _recv_buffer() -> tuple[bytearray, memoryview]:
+    buffer = getattr(_tls, "buffer", None)
+    if buffer is None:
+        buffer = _tls.buffer = bytearray(MAX_DATA_RECV)
+        _tls.view = memoryview(buffer)
+    return buffer, _tls.view
+
+
+# Receive one HTTP request from sock into buffer (this thread's request buffer,
+# with view a memoryview of it), which already starts with `filled` bytes left
+# over from the previous request on the connection. Returns the request (its
+# header block and any Content-Length body) and how many bytes received after
+# it are now at the start of buffer, or (None, 0) if the client closed the
+# connection first. Raises ValueError for requests it cannot safely frame, or
+# whose body is too large
+def _receive_request(
+    sock: socket.socket, buffer: bytearray, view: memoryview, filled: int
+) -> tuple[bytes | None, int]:
+    # Each search starts just before the bytes it has not seen yet (3 bytes
+    # back, in case the terminator is split between reads)
+    scanned = 0
+    while True:
+        headerEnd = buffer.find(b"\r\n\r\n", max(0, scanned - 3), filled)
+        if headerEnd >= 0:
+            break
+        scanned = filled
+        if filled == len(buffer):
+            raise ValueError("Request header too large")
+        received = sock.recv_into(view[filled:])
+        if not received:
+            return None, 0
+        filled += received
+
+    # Bodies are only framed by Content-Length. Requests whose framing could
+    # be read differently by the server they are passed on to (chunked or
+    # other transfer codings, several lengths, malformed lengths) are refused
+    # rather than risk taking part of a body for the next request
+    end = headerEnd + 4
+    headers = bytes(buffer[:headerEnd]).lower()
+    if _header_value(headers, b"transfer-encoding") is not None:
+        raise ValueError("Transfer-Encoding in requests is not supported")
+    contentLength = _header_value(headers, b"content-length")
+    if contentLength is not None:
+        if not contentLength.isdigit() or headers.count(b"\r\ncontent-length:") > 1:
+            raise ValueError("Invalid Content-Length in request")
+        if int(contentLength) > MAX_REQUEST_BODY:
+            sock.sendall(_TOO_LARGE_RESPONSE)
+            raise ValueError("Request body too large")
+        end += int(contentLength)
+
+    # Move whatever follows the request to the start of the buffer
+    if end <= filled:
+        request = bytes(buffer[:end])
+        buffer[: filled - end] = buffer[end:filled]
+        return request, filled - end
+
+    # The body runs past what has been received so far. It has CLIENT_TIMEOUT
+    # to arrive in full, however steadily it trickles in
+    longRequest = bytearray(buffer[:filled])
+    deadline = time.monotonic() + CLIENT_TIMEOUT
+    while len(longRequest) < end:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("Request body not received in time")
+        sock.settimeout(remaining)
+        data = sock.recv(min(CHUNK_SIZE, end - len(longRequest)))
+        if not data:
+            return None, 0
+        longRequest += data
+    sock.settimeout(CLIENT_TIMEOUT)
+    return bytes(longRequest), 0
+
+
+# Return whether a client's request lets the connection stay open for another
+# one: HTTP/1.1 requests that do not ask to close it. (HTTP/1.0 keep-alive is
+# not offered, since the responses do not echo a keep-alive header.)
+def _request_keeps_alive(request: bytes) -> bool:
+    lineEnd = request.find(b"\r\n")
+    if not request.endswith(b"HTTP/1.1", 0, lineEnd):
+        return False
+    connection = _header_value(
+        request[: request.find(b"\r\n\r\n")].lower(), b"connection"
+    )
+    return connection is None or b"close" not in connection
+
+
+# Return a view of a free upstream response buffer, allocating one if none is
+# free; hand it back to _release_chunk when done
+def _acquire_chunk() -> memoryview:
+    try:
+        return _chunk_pool.get_nowait()
+    except queue.Empty:
+        return memoryview(bytearray(CHUNK_SIZE))
+
+
+def _release_chunk(chunk: memoryview) -> None:
+    _chunk_pool.put(chunk)
+
+
+# Send every buffer in buffers on sock, gathering them into a single writev(2)
+# per call where the platform supports sendmsg
+def _sendmsg_all(sock: socket.socket, buffers: list | tuple) -> None:
+    if not hasattr(sock, "sendmsg"):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+
+    views = [memoryview(buffer) for buffer in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+
+        # Drop the buffers that were sent in full, and the sent part of the
+        # first one that wasn't
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+
+# Return the target of an HTTP request line (e.g. "/index.html"), scanning the
+# raw request bytes rather than decoding and splitting the whole request. It is
+# decoded as Latin-1, which maps each byte to one character, so it cannot fail
+# and .encode("latin-1") recovers the original bytes
+def _request_target(request: bytes) -> str:
+    start = request.find(b" ") + 1
+    end = request.find(b" ", start)
+    if start == 0 or end < 0:
+        raise ValueError("Malformed HTTP request line")
+    return request[start:end].decode("latin-1")
+
+
+# Return the proxy cache key of a request: the lower-case host without a
+# default port, the path with repeated slashes collapsed, and the query, so
+# equivalent URLs share a cache entry (the fragment is left out). Only
+# absolute-form targets ("http://host/path") are parsed as URLs: urlsplit would
+# read an origin-form target starting with "//" as an authority, so "//x/b"
+# would share the key of "/b"
+def _cache_key(hostname: str, target: str) -> tuple[str, str, str]:
+    if target.startswith("/"):
+        path, _, query = target.partition("#")[0].partition("?")
+    else:
+        url = urlsplit(target)
+        path, query = url.path, url.query
+    host = hostname.lower()
+    if host.endswith(":80"):
+        host = host[:-3]
+    path = re.sub("//+", "/", path) or "/"
+    return (host, path, query)
+
+
+# Return the value of a header in a lower-cased header block, or None if the
+# block has no such header
+def _header_value(headers: bytes, name: bytes) -> bytes | None:
+    start = headers.find(b"\r\n" + name + b":")
+    if start < 0:
+        return None
+    start += len(name) + 3
+    end = headers.find(b"\r\n", start)
+    return headers[start : end if end >= 0 else len(headers)].strip()
+
+
+# Return how the body of a response with the header block head is delimited:
+# its length (None if it is chunked or runs until the server closes the
+# connection), whether it is chunked, and whether the server keeps the
+# connection open after it
+def _response_framing(
+    head: bytes | bytearray, isHead: bool
+) -> tuple[int | None, bool, bool]:
+    head = bytes(head).lower()
+    status = int(head[9:12])
+    connection = _header_value(head, b"connection")
+    if head.startswith(b"http/1.1"):
+        keepAlive = connection is None or b"close" not in connection
+    else:
+        keepAlive = connection is not None and b"keep-alive" in connection
+
+    # Informational responses are followed by another response, which is
+    # simplest to read until the server closes the connection
+    if status < 200:
+        return None, False, False
+    if isHead or status in (204, 304):
+        return 0, False, keepAlive
+
+    transferEncoding = _header_value(head, b"transfer-encoding")
+    if transferEncoding is not None and b"chunked" in transferEncoding:
+        return None, True, keepAlive
+    contentLength = _header_value(head, b"content-length")
+    if contentLength is not None:
+        return int(contentLength), False, keepAlive
+    return None, False, False
+
+
+# Return whether a complete response marks its own end (by its length or
+# chunked encoding), so the connection it is sent on can carry another one
+def _response_delimited(response: bytes, isHead: bool) -> bool:
+    headerEnd = response.find(b"\r\n\r\n")
+    if headerEnd < 0:
+        return False
+    length, chunked, _ = _response_framing(response[: headerEnd + 4], isHead)
+    return length is not None or chunked
+
+
+# Scan the chunks of a chunked response in buffer from pos (the start of a
+# chunk size line), returning where the response ends if its last chunk has
+# arrived (else None) and the position to resume scanning from
+def _chunked_end(buffer: bytes | bytearray, pos: int) -> tuple[int | None, int]:
+    while True:
+        lineEnd = buffer.find(b"\r\n", pos)
+        if lineEnd < 0:
+            return None, pos
+        size = int(buffer[pos:lineEnd].split(b";")[0], 16)
+
+        # The last chunk is followed by optional trailers and an empty line
+        if size == 0:
+            end = buffer.find(b"\r\n\r\n", lineEnd)
+            return (end + 4 if end >= 0 else None), pos
+
+        if len(buffer) < lineEnd + size + 4:
+            return None, pos
+        pos = lineEnd + size + 4
+
+
+# Return request with its Connection header replaced by one asking the server
+# to keep the connection open
+def _keep_alive_request(request: bytes) -> bytes:
+    headEnd = request.find(b"\r\n\r\n")
+    if headEnd < 0:
+        return request
+    start = request[:headEnd].lower().find(b"\r\nconnection:")
+    if start >= 0:
+        end = request.find(b"\r\n", start + 2)
+        request = request[:start] + request[end:]
+    lineEnd = request.find(b"\r\n")
+    return request[:lineEnd] + b"\r\nConnection: keep-alive" + request[lineEnd:]
+
+
+# Return how many seconds a proxied response may be cached for, or 0 if it
+# must not be (its status is not cacheable, or Cache-Control forbids it): its
+# Cache-Control max-age if it has one, otherwise PROXY_CACHE_TTL for
+# successful responses and PROXY_ERROR_TTL for errors. A response to a request
+# with an Authorization header (authorized) is only cached if Cache-Control
+# explicitly allows a shared cache to store it
+def _response_ttl(response: bytes, authorized: bool = False) -> float:
+    if not response.startswith(b"HTTP/"):
+        return 0
+    try:
+        status = int(response[9:12])
+    except ValueError:
+        return 0
+    if status not in _CACHEABLE_STATUSES:
+        return 0
+
+    end = response.find(b"\r\n\r\n")
+    headers = response[: end if end >= 0 else len(response)].lower()
+    cacheControl = _header_value(headers, b"cache-control")
+    if authorized and (
+        cacheControl is None
+        or not any(
+            d in cacheControl for d in (b"public", b"s-maxage", b"must-revalidate")
+        )
+    ):
+        return 0
+    if cacheControl is not None:
+        # A shared cache must not store private responses, and no-cache ones
+        # would have to be revalidated on every hit
+        if any(d in cacheControl for d in (b"no-store", b"no-cache", b"private")):
+            return 0
+        maxAge = _MAX_AGE.search(cacheControl)
+        if maxAge is not None:
+            return int(maxAge.group(1))
+
+    return PROXY_ERROR_TTL if status >= 400 else PROXY_CACHE_TTL
+
+
+# Return the value of the Host header of an HTTP request (lower-cased, as host
+# names are case-insensitive), or None if it has none. Only the header block
+# is searched, so a body cannot supply the host
+def _request_host(request: bytes) -> str | None:
+    end = request.find(b"\r\n\r\n")
+    headers = request[: end if end >= 0 else len(request)].lower()
+    host = _header_value(headers, b"host")
+    return host.decode("latin-1") if host is not None else None
+
+
+# Return a payload of n copies of ch, shared between probes of the same size
+def _payload(n: int, ch=b"A"):
+    key = (n, ch)
+    data = _PAYLOAD_CACHE.get(key)
+    if data is None:
+        data = _PAYLOAD_CACHE.setdefault(key, ch * n)
+    return data
+
+
+# Resolve a hostname to an IP address; raises socket.gaierror if it is invalid
+def _resolve_host(name: str, ttl=_A_TTL):
+    now = time.monotonic()
+    with _dns_cache_lock:
+        entry = _a_cache.get(name)
+    if entry is not None and entry[1] > now:
+        return entry[0]
+
+    address = socket.gethostbyname(name)
+
+    with _dns_cache_lock:
+        _a_cache[name] = (address, now + ttl)
+    return address
+
+
+# Resolve an IP address to its hostname, or None if it has no PTR record
+def _resolve_ptr(address: str):
+    now = time.monotonic()
+    with _dns_cache_lock:
+        entry = _ptr_cache.get(address)
+    if entry is not None and entry[1] > now:
+        return entry[0]
+
+    # Do the lookup without holding the lock so other threads are not blocked
+    try:
+        hostName = socket.gethostbyaddr(address)[0]
+        expiry = now + _PTR_TTL
+    except (socket.herror, socket.gaierror):
+        hostName = None
+        expiry = now + _PTR_NEGATIVE_TTL
+
+    with _dns_cache_lock:
+        _ptr_cache[address] = (hostName, expiry)
+    return hostName
 
 
 def setupArgumentParser() -> argparse.Namespace:
@@ -95,7 +563,7 @@ def setupArgumentParser() -> argparse.Namespace:
     parser_w.set_defaults(func=WebServer)
 
     parser_x = subparsers.add_parser("proxy", aliases=["x"], help="run proxy")
-    parser_x.set_defaults(port=8000)
+    parser_x.set_defaults(port=8000, cache_size=PROXY_CACHE_ENTRIES)
     parser_x.add_argument(
         "--port",
         "-p",
@@ -103,6 +571,12 @@ def setupArgumentParser() -> argparse.Namespace:
         nargs="?",
         help="port number to start web server listening on",
     )
+    parser_x.add_argument(
+        "--cache-size",
+        "-c",
+        type=int,
+        help="maximum number of responses to keep in the cache",
+    )
     parser_x.set_defaults(func=Proxy)
 
     if len(sys.argv) < 2:
@@ -117,22 +591,16 @@ def setupArgumentParser() -> argparse.Namespace:
 class NetworkApplication:
 
     def checksum(self, dataToChecksum: bytes) -> int:
-        csum = 0
-        countTo = (len(dataToChecksum) // 2) * 2
-        count = 0
-
-        while count < countTo:
-            thisVal = dataToChecksum[count + 1] * 256 + dataToChecksum[count]
-            csum = csum + thisVal
-            csum = csum & 0xFFFFFFFF
-            count = count + 2
-
-        if countTo < len(dataToChecksum):
-            csum = csum + dataToChecksum[len(dataToChecksum) - 1]
-            csum = csum & 0xFFFFFFFF
-
-        csum = (csum >> 16) + (csum & 0xFFFF)
-        csum = csum + (csum >> 16)
+        # Read the whole buffer as one little-endian integer. Since
+        # 2**16 == 1 (mod 0xFFFF), reducing it mod 0xFFFF is the same as the
+        # end-around-carry sum of all its 16-bit words (an odd trailing byte
+        # is the low byte of the last word). The reduction is one pass
+        # over the buffer in C, with no per-word Python work
+        value = int.from_bytes(dataToChecksum, "little")
+        csum = value % 0xFFFF
+        # Non-zero data that sums to a multiple of 0xFFFF folds to 0xFFFF
+        if csum == 0 and value:
+            csum = 0xFFFF
         answer = ~csum
         answer = answer & 0xFFFF
         answer = answer >> 8 | (answer << 8 & 0xFF00)
@@ -141,6 +609,11 @@ class NetworkApplication:
 
         return answer
 
+    # Check the checksum of the ICMP message (header + payload) in a received
+    # IP packet: summing a message that includes its checksum gives zero
+    def verifyIcmpChecksum(self, packet, ipHeaderLen: int) -> bool:
+        return self.checksum(packet[ipHeaderLen:]) == 0
+
     # Print Ping output
     def printOneResult(
         self,
@@ -176,9 +649,10 @@ class NetworkApplication:
             print(
                 f"{numPacketsTransmitted} packets transmitted, {len(rtts)} received, {lossPercent}% packet loss"
             )
+            # Every pass over rtts runs in C except the deviation sum, which
+            # streams through a generator rather than building a list
             avgRTT = sum(rtts) / len(rtts)
-            deviations = [abs(rtt - avgRTT) for rtt in rtts]
-            mdev = sum(deviations) / len(deviations)
+            mdev = sum(abs(rtt - avgRTT) for rtt in rtts) / len(rtts)
             minRTT = min(rtts)
             maxRTT = max(rtts)
             print(
@@ -194,6 +668,7 @@ class NetworkApplication:
         hop_addrs: dict,
         rtts: dict,
         destinationHostname="",
+        name_lookup=None,
     ):
         if pkt_keys is None:
             print(f"{ttl:2}   * * *")
@@ -214,16 +689,17 @@ class NetworkApplication:
             # Get the RTT for the probe
             rtt = rtts[pkt_key]
             if last_hop_addr is None or hop_addr != last_hop_addr:
-                hostName = None
-                try:
-                    # Get the hostname for the hop
-                    hostName = socket.gethostbyaddr(hop_addr)[0]
-                    if last_hop_addr is None:
-                        output += hostName + " "
-                    else:
-                        output += " " + hostName + " "
-                except socket.herror:
+                # Get the hostname for the hop, preferring names resolved up front
+                if name_lookup is not None:
+                    hostName = name_lookup.get(hop_addr)
+                else:
+                    hostName = _resolve_ptr(hop_addr)
+                if hostName is None:
                     output += hop_addr + " "
+                elif last_hop_addr is None:
+                    output += hostName + " "
+                else:
+                    output += " " + hostName + " "
                 last_hop_addr = hop_addr
                 last_hop_name = hostName
                 output += "(" + hop_addr + ") "
@@ -233,6 +709,153 @@ class NetworkApplication:
 
         print(output)
 
+    # Print traceroute output for a list of (ttl, pkt_keys, hop_addrs, rtts) rows
+    def printTracerouteResults(self, rows: list, destinationHostname=""):
+        # Resolve the hostnames of all hops concurrently, rather than one
+        # blocking lookup at a time while printing
+        unique_ips = set(
+            hop_addr
+            for row in rows
+            for hop_addr in row[2].values()
+            if hop_addr is not None
+        )
+        name_lookup = {}
+        if unique_ips:
+            with ThreadPoolExecutor(max_workers=MAX_DNS_WORKERS) as executor:
+                name_lookup = dict(
+                    zip(unique_ips, executor.map(_resolve_ptr, unique_ips))
+                )
+
+        for ttl, pkt_keys, hop_addrs, rtts in rows:
+            self.printMultipleResults(
+                ttl, pkt_keys, hop_addrs, rtts, destinationHostname, name_lookup
+            )
+
+    # Set up a TCP socket, before it is bound, to listen for connections:
+    # allow it to rebind while old connections are in TIME_WAIT, let several
+    # processes share the port (with the kernel balancing connections between
+    # them) and give it large socket buffers for fast transfers
+    def configureListener(self, listenSocket):
+        listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+
+    # Accept connections on listenSocket and hand each one to a worker thread
+    # in pool once the client has sent a whole request header block. Until
+    # then the connection waits in a selector, which collects the header
+    # without blocking, so idle or slowly sending clients cost a file
+    # descriptor and a header buffer rather than a whole worker thread.
+    # Workers hand kept-alive connections back with returnConnection. A
+    # connection is closed if it waits CLIENT_TIMEOUT for a request to start,
+    # or if a header takes longer than CLIENT_TIMEOUT to arrive after its
+    # first byte, however steadily it trickles in.
+    def serveConnections(self, listenSocket, pool, label):
+        selector = selectors.DefaultSelector()
+        listenSocket.setblocking(False)
+        selector.register(listenSocket, selectors.EVENT_READ)
+
+        # Returned connections are queued, and the selector woken by a byte
+        # written to this socket pair
+        self.returnedConnections: queue.SimpleQueue[tuple[socket.socket, bytes]] = (
+            queue.SimpleQueue()
+        )
+        wakeReader, self.wakeWriter = socket.socketpair()
+        wakeReader.setblocking(False)
+        self.wakeWriter.setblocking(False)
+        selector.register(wakeReader, selectors.EVENT_READ)
+
+        # Waiting connections, with the time each one is closed at. Each is
+        # registered with the part of its next request received so far
+        deadlines = {}
+        nextSweep = time.monotonic() + 1
+
+        def wait(connectionSocket, pending):
+            connectionSocket.setblocking(False)
+            selector.register(connectionSocket, selectors.EVENT_READ, pending)
+            deadlines[connectionSocket] = time.monotonic() + CLIENT_TIMEOUT
+
+        def drop(connectionSocket):
+            selector.unregister(connectionSocket)
+            del deadlines[connectionSocket]
+            connectionSocket.close()
+
+        while True:
+            for key, _ in selector.select(timeout=1):
+                if key.fileobj is listenSocket:
+                    try:
+                        connectionSocket, addr = listenSocket.accept()
+                    except BlockingIOError:
+                        continue
+                    print(f"{label} established with {addr}")
+
+                    # Send small responses immediately rather than waiting to
+                    # coalesce them
+                    connectionSocket.setsockopt(
+                        socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+                    )
+                    wait(connectionSocket, bytearray())
+                elif key.fileobj is wakeReader:
+                    try:
+                        wakeReader.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    while not self.returnedConnections.empty():
+                        connectionSocket, pending = self.returnedConnections.get()
+                        wait(connectionSocket, bytearray(pending))
+                else:
+                    connectionSocket = key.fileobj
+                    pending = key.data
+                    try:
+                        received = connectionSocket.recv(MAX_DATA_RECV - len(pending))
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        received = b""
+                    if not received:
+                        drop(connectionSocket)
+                        continue
+
+                    # The header has CLIENT_TIMEOUT from its first byte to
+                    # arrive, which further bytes do not extend
+                    if not pending:
+                        deadlines[connectionSocket] = time.monotonic() + CLIENT_TIMEOUT
+                    searchFrom = max(0, len(pending) - 3)
+                    pending += received
+                    if pending.find(b"\r\n\r\n", searchFrom) < 0:
+                        # Headers that do not fit the request buffer are refused
+                        if len(pending) >= MAX_DATA_RECV:
+                            drop(connectionSocket)
+                        continue
+
+                    # The worker does blocking reads and writes, but gives up
+                    # on a client that stalls
+                    selector.unregister(connectionSocket)
+                    del deadlines[connectionSocket]
+                    connectionSocket.settimeout(CLIENT_TIMEOUT)
+                    pool.submit(self.handleRequest, connectionSocket, bytes(pending))
+
+            now = time.monotonic()
+            if now >= nextSweep:
+                for connectionSocket, deadline in list(deadlines.items()):
+                    if deadline <= now:
+                        drop(connectionSocket)
+                nextSweep = now + 1
+
+    # Hand a connection whose requests have all been answered back to
+    # serveConnections, to wait there for the rest of the client's next
+    # request, of which pending has been received already
+    def returnConnection(
+        self, connectionSocket: socket.socket, pending: bytes = b""
+    ) -> None:
+        self.returnedConnections.put((connectionSocket, pending))
+        try:
+            self.wakeWriter.send(b"\0")
+        except BlockingIOError:
+            # The selector already has wake-ups waiting
+            pass
+
 
 class ICMPPing(NetworkApplication):
 
@@ -240,7 +863,7 @@ class ICMPPing(NetworkApplication):
         host = None
         # 1. Look up hostname, resolving it to an IP address
         try:
-            host = socket.gethostbyname(args.hostname)
+            host = _resolve_host(args.hostname)
         except socket.gaierror:
             print("Invalid hostname: ", args.hostname)
             return
@@ -259,6 +882,10 @@ class ICMPPing(NetworkApplication):
         # 2. Set a timeout on the socket
         self.icmpSocket.settimeout(args.timeout)
 
+        # Allocate the buffer that every reply is received into
+        self._rxbuf = bytearray(MAX_DATA_RECV)
+        self._rxview = memoryview(self._rxbuf)
+
         # 3. Send ping probes and collect responses
         numPings = args.count
         seq_num = 0
@@ -268,6 +895,7 @@ class ICMPPing(NetworkApplication):
             while numPings > 0:
 
                 # 4. Do one ping approximately every second
+                pingStart = time.time()
                 rtt, ttl, packetSize, seq = self.doOnePing(host, args.timeout, seq_num)
 
                 # 5. Print out the RTT (and other relevant details) using the printOneResult method
@@ -275,8 +903,10 @@ class ICMPPing(NetworkApplication):
                     self.printOneResult(host, packetSize, rtt * 1000, seq, ttl)
                     rtts.append(rtt)
 
-                # 6. Sleep for a second
-                time.sleep(1)
+                # 6. Sleep for the rest of the second (the time spent waiting
+                # for the reply counts towards it), unless this was the last ping
+                if numPings > 1:
+                    time.sleep(max(0.0, 1.0 - (time.time() - pingStart)))
 
                 # 7. Update sequence number and number of pings
                 seq_num += 1
@@ -298,7 +928,8 @@ class ICMPPing(NetworkApplication):
         echoReplyPacket = None
         isTimedout = False
         try:
-            echoReplyPacket, addr = self.icmpSocket.recvfrom(MAX_DATA_RECV)
+            nbytes, addr = self.icmpSocket.recvfrom_into(self._rxbuf)
+            echoReplyPacket = self._rxview[:nbytes]
         except socket.timeout as e:
             isTimedout = True
 
@@ -319,7 +950,6 @@ class ICMPPing(NetworkApplication):
         # |           Destination IP Address (32 bits, i.e., 4 bytes)  |
         # |     Option (up to 40 bytes) this is an optional field      |
 
-        ip_header = echoReplyPacket[:20]
         (
             version_ihl,
             tos,
@@ -331,7 +961,7 @@ class ICMPPing(NetworkApplication):
             checksum,
             src_ip,
             dest_ip,
-        ) = struct.unpack("!BBHHHBBH4s4s", ip_header)
+        ) = _IP_HDR.unpack_from(echoReplyPacket)
 
         # Read the IP Header Length (using bit masking)
         ip_header_len_field = version_ihl & 0x0F
@@ -342,15 +972,18 @@ class ICMPPing(NetworkApplication):
 
         payloadSize = total_length - ip_header_len
 
+        # 4. Discard replies that were corrupted in transit
+        if not self.verifyIcmpChecksum(echoReplyPacket, ip_header_len):
+            return None, None, None, None
+
         # Now parse the ICMP header:
         # 0         8           16         24          32 bits
         #     Type  |    Code   |       Checksum       |
         #     Packet Identifier |       Sequence num   |
         #        <Optional timestamp (8 bytes) for     |
         #        a stateless ping>                     |
-        icmpHeader = echoReplyPacket[ip_header_len : ip_header_len + 8]
-        icmpType, code, checksum, p_id, sequenceNumReceived = struct.unpack(
-            "!BBHHH", icmpHeader
+        icmpType, code, checksum, p_id, sequenceNumReceived = _ICMP_HDR.unpack_from(
+            echoReplyPacket, ip_header_len
         )
 
         # 5. Check that the ID and sequence numbers match between the request and reply
@@ -365,26 +998,41 @@ class ICMPPing(NetworkApplication):
     def sendOnePing(
         self, destinationAddress, packetID, sequenceNumber, ttl=None, dataLength=0
     ):
-        # 1. Build ICMP header
-        header = struct.pack(
-            "!BBHHH", ICMP_ECHO_REQUEST, 0, 0, packetID, sequenceNumber
-        )
-
-        # 2. Checksum ICMP packet using given function
-        # include some bytes 'AAA...' in the data (payload) of ping
-        data = str.encode(dataLength * "A")
-        my_checksum = self.checksum(header + data)
+        # 1. Build ICMP header in a buffer reused across probes
+        # include some bytes 'AAA...' in the data (payload) of ping, which
+        # is only written when the buffer is created
+        packet = getattr(self, "_echoBuffer", None)
+        if packet is None or len(packet) != 8 + dataLength:
+            packet = self._echoBuffer = bytearray(8 + dataLength)
+            packet[8:] = _payload(dataLength, b"A")
+
+        # 2. Checksum ICMP packet
+        if dataLength == len(_PAYLOAD):
+            # The ping payload never changes, so add its precomputed sum to
+            # the header words (type/code, identifier, sequence number; the
+            # checksum field counts as zero) and fold, in network byte order
+            csum = _PAYLOAD_SUM + (ICMP_ECHO_REQUEST << 8) + packetID + sequenceNumber
+            while csum >> 16:
+                csum = (csum >> 16) + (csum & 0xFFFF)
+            my_checksum = ~csum & 0xFFFF
+        else:
+            # Otherwise checksum the packet using given function
+            _ICMP_HDR.pack_into(
+                packet, 0, ICMP_ECHO_REQUEST, 0, 0, packetID, sequenceNumber
+            )
+            my_checksum = socket.htons(self.checksum(packet))
 
         # 3. Insert checksum into packet
         # NOTE: it is optional to include an additional 8-byte timestamp (time when probe is sent)
         # in which case, a stateless ping can be implemented: the response will contain
         # the sending time so no need to keep that state,
         # but we don't do that here (instead, we record sending time state in step 5)
-        packet = struct.pack(
-            "!BBHHH",
+        _ICMP_HDR.pack_into(
+            packet,
+            0,
             ICMP_ECHO_REQUEST,
             0,
-            socket.htons(my_checksum),
+            my_checksum,
             packetID,
             sequenceNumber,
         )
@@ -393,7 +1041,7 @@ class ICMPPing(NetworkApplication):
             self.icmpSocket.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
 
         # 4. Send packet using socket
-        self.icmpSocket.sendto(packet + data, (destinationAddress, 1))
+        self.icmpSocket.sendto(packet, (destinationAddress, 1))
 
         # 5. Record time of sending (state)
         timeSent = time.time()
@@ -433,7 +1081,7 @@ class Traceroute(ICMPPing):
         # 1. Look up hostname, resolving it to an IP address
         self.dstAddress = None
         try:
-            self.dstAddress = socket.gethostbyname(args.hostname)
+            self.dstAddress = _resolve_host(args.hostname)
             # socket.getaddrinfo(args.hostname, None, socket.AF_INET6)
         except socket.gaierror:
             print("Invalid hostname: ", args.hostname)
@@ -459,184 +1107,260 @@ class Traceroute(ICMPPing):
         # 4. Set a timeout on the socket
         self.icmpSocket.settimeout(args.timeout)
 
-        # 5. Run traceroute
+        # Allocate the buffer that every reply is received into
+        self._rxbuf = bytearray(MAX_DATA_RECV)
+        self._rxview = memoryview(self._rxbuf)
+
+        # 5. Create the UDP socket used to send every UDP probe
+        self.udpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, UDP_CODE)
+        self.udpSocket.bind(("", 0))
+        self.udpPort = self.udpSocket.getsockname()[1]
+
+        # 6. Run traceroute
         self.runTraceroute()
 
-        # 6. Close ICMP socket
+        # 7. Close ICMP and UDP sockets
         self.icmpSocket.close()
+        self.udpSocket.close()
 
     def runTraceroute(self):
 
-        hopAddr = None
-        pkt_keys = []
-        hop_addrs = dict()
-        rtts = dict()
-        ttl = 1
+        if args.protocol not in ("icmp", "udp"):
+            print(f"Error: invalid protocol {args.protocol}. Use udp or icmp")
+            sys.exit(1)
+
+        # Probes for every TTL are launched back to back instead of waiting
+        # for each TTL's replies in turn; replies are matched to their probe
+        # by its key (ICMP sequence number or UDP destination port)
+        self.probes_sent = {}  # {ttl: {probe key: time sent}}
+        self.probe_ttls = {}  # {probe key: ttl}
+        self.rtt_received = {}  # {ttl: {probe key: rtt}}
+        self.hop_addresses = {}  # {ttl: {probe key: hop address}}
+        self.destinationTtl = None
 
         try:
+            # 1. Send the probes for each TTL, until the destination has replied
+            ttl = 1
             while ttl <= MAX_TTL and self.isDestinationReached == False:
-                if args.protocol == "icmp":
-                    self.sendIcmpProbesAndCollectResponses(ttl)
-
-                elif args.protocol == "udp":
-                    self.sendUdpProbesAndCollectResponses(ttl)
-                else:
-                    print(f"Error: invalid protocol {args.protocol}. Use udp or icmp")
-                    sys.exit(1)
+                self.sendTracerouteProbes(ttl)
                 ttl += 1
+
+            # 2. Wait for the replies to the remaining probes
+            self.collectTracerouteResponses(time.time() + args.timeout)
         except KeyboardInterrupt:
             print("\nKeyboard Interrupt")
+            self.printTracerouteResults(self.tracerouteRows(), args.hostname)
             sys.exit(0)
 
-    # Send 3 ICMP traceroute probes per TTL and collect responses
-    def sendIcmpProbesAndCollectResponses(self, ttl):
-
-        hopAddr = None
-        icmpType = None
-        pkt_keys = []
-        hop_addrs = dict()
-        rtts = dict()
-
-        for seq_num in range(3):  # Send 3 ICMP probes for each TTL value
-            # 1. Send one ICMP probe
-            packetID = self.packetID
-            timeSent = self.sendOnePing(self.dstAddress, packetID, seq_num, ttl, 0)
+        # 3. Print the results once all hops are collected
+        self.printTracerouteResults(self.tracerouteRows(), args.hostname)
 
-            # 2. Record a unique key (sequence number) associated with the probe
-            pkt_keys.append(seq_num)
+    # Send 3 traceroute probes for one TTL, collecting replies in between
+    def sendTracerouteProbes(self, ttl):
 
-            # 3. Receive the response (if one arrives within the timeout)
-            trReplyPacket, hopAddr, timeRecvd = self.receiveOneTraceRouteResponse()
-            if trReplyPacket is None:
-                # Nothing is received within the timeout period
-                continue
+        for probe in range(3):
+            # 1. Send one probe
+            self.sendTracerouteProbe(ttl, probe)
 
-            # 4. Extract ICMP type and code from the reply
-            icmpType = self.parseICMPTracerouteResponse(trReplyPacket)
+            # 2. Receive any replies that arrive before the next probe is due,
+            # so their receive time is not delayed by the remaining sends
+            self.collectTracerouteResponses(time.time() + SEND_LAUNCH_INTERVAL)
 
-            # 5. Check if we reached the destination
-            if self.dstAddress == hopAddr and icmpType == 0:
-                self.isDestinationReached = True
+    # Send one traceroute probe, with a key that is unique across all TTLs
+    def sendTracerouteProbe(self, ttl, probe):
 
-            # 6. Record the rtt and the hop address
-            rtts[seq_num] = timeRecvd - timeSent
-            hop_addrs[seq_num] = hopAddr
+        # 1. Send the probe, keyed by ICMP sequence number or UDP destination port
+        key = (ttl - 1) * 3 + probe
+        if args.protocol == "icmp":
+            timeSent = self.sendOnePing(self.dstAddress, self.packetID, key, ttl, 0)
+        else:
+            key += UDP_BASE_PORT
+            timeSent = self.sendOneUdpProbe(
+                self.dstAddress, key, ttl, len(_PROBE_PAYLOAD)
+            )
 
-        # 7. Print one line of the results for the 3 probes
-        self.printMultipleResults(ttl, pkt_keys, hop_addrs, rtts, args.hostname)
+        # 2. Record the key and sending time of the probe
+        self.probes_sent.setdefault(ttl, {})[key] = timeSent
+        self.rtt_received.setdefault(ttl, {})
+        self.hop_addresses.setdefault(ttl, {})
+        self.probe_ttls[key] = ttl
+
+    # Receive traceroute replies until the given time, or until every probe up
+    # to the destination has been answered
+    def collectTracerouteResponses(self, deadline):
+
+        while not self.isTracerouteComplete():
+            # 1. Receive one packet, or stop once the deadline has passed
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            self.icmpSocket.settimeout(remaining)
+            trReplyPacket, hopAddr, timeRecvd = self.receiveOneTraceRouteResponse()
+            if trReplyPacket is None:
+                return
 
-    # Send 3 UDP traceroute probes per TTL and collect responses
-    def sendUdpProbesAndCollectResponses(self, ttl):
+            # 2. Match the reply to its probe
+            self.recordTracerouteResponse(trReplyPacket, hopAddr, timeRecvd)
 
-        hopAddr = None
-        icmpType = None
-        pkt_keys = []
-        hop_addrs = dict()
-        rtts = dict()
+    # Record the rtt and hop address of the probe a reply answers, if any
+    def recordTracerouteResponse(self, trReplyPacket, hopAddr, timeRecvd):
 
-        numBytes = 52
-        dstPort = 33439
+        # 1. Extract the probe key and ICMP type from the reply
+        if args.protocol == "icmp":
+            key, icmpType = self.parseICMPTracerouteResponse(trReplyPacket)
+            destinationType = 0
+        else:
+            key, icmpType = self.parseUDPTracerouteResponse(trReplyPacket)
+            destinationType = 3
 
-        for _ in range(3):
-            # 1. Send one UDP traceroute probe
-            dstPort += 1
-            timeSent = self.sendOneUdpProbe(self.dstAddress, dstPort, ttl, numBytes)
+        # 2. Ignore packets that do not answer one of our probes
+        ttl = self.probe_ttls.get(key)
+        if ttl is None or key in self.rtt_received[ttl]:
+            return
 
-            # 2. Record a unique key (UDP destination port) associated with the probe
-            pkt_keys.append(dstPort)
+        # 3. Record the rtt and the hop address
+        self.rtt_received[ttl][key] = timeRecvd - self.probes_sent[ttl][key]
+        self.hop_addresses[ttl][key] = hopAddr
 
-            # 3. Receive the response (if one arrives within the timeout)
-            trReplyPacket, hopAddr, timeRecvd = self.receiveOneTraceRouteResponse()
-            if trReplyPacket is None:
-                # Nothing is received within the timeout period
-                continue
+        # 4. Check if we reached the destination
+        if self.dstAddress == hopAddr and icmpType == destinationType:
+            self.isDestinationReached = True
+            if self.destinationTtl is None or ttl < self.destinationTtl:
+                self.destinationTtl = ttl
 
-            # 4. Extract destination port from the reply
-            dstPortReceived, icmpType = self.parseUDPTracerouteResponse(trReplyPacket)
+    # The traceroute is complete once every probe up to the destination is answered
+    def isTracerouteComplete(self):
 
-            # 5. Check if we reached the destination
-            if self.dstAddress == hopAddr and icmpType == 3:
-                self.isDestinationReached = True
+        if self.destinationTtl is None:
+            return False
+        return all(
+            len(self.rtt_received[ttl]) == len(self.probes_sent[ttl])
+            for ttl in range(1, self.destinationTtl + 1)
+        )
 
-            # 6. If the response matches the request, record the rtt and the hop address
-            if dstPort == dstPortReceived:
-                rtts[dstPort] = timeRecvd - timeSent
-                hop_addrs[dstPort] = hopAddr
+    # Build one (ttl, pkt_keys, hop_addrs, rtts) row per TTL, up to the destination
+    def tracerouteRows(self):
 
-        # 7. Print one line of the results for the 3 probes
-        self.printMultipleResults(ttl, pkt_keys, hop_addrs, rtts, args.hostname)
+        lastTtl = self.destinationTtl or MAX_TTL
+        return [
+            (
+                ttl,
+                list(self.probes_sent[ttl].keys()),
+                self.hop_addresses[ttl],
+                self.rtt_received[ttl],
+            )
+            for ttl in sorted(self.probes_sent)
+            if ttl <= lastTtl
+        ]
 
     # Parse the response to UDP probe
     def parseUDPTracerouteResponse(self, trReplyPacket):
+        # An empty read holds no IP header to parse
+        if not trReplyPacket:
+            return None, None
 
-        # 1. Parse the IP header
-        dst_port = None
-        # Extract the first 20 bytes
-        ip_header = struct.unpack("!BBHHHBBH4s4s", trReplyPacket[:20])
+        # 1. Read the IP Header Length from the first byte of the IP header
+        # (using bit masking); no other IP header field is needed
+        ip_header_len_field = trReplyPacket[0] & 0x0F
 
-        # 2. Read the IP Header Length (using bit masking)
-        ip_header_len_field = ip_header[0] & 0x0F
-
-        # 3. Compute the IP header length
+        # 2. Compute the IP header length
         # This field contains the length of the IP header in terms of
         # the number of 4-byte words. So value 5 indicates 5*4 = 20 bytes.
         ip_header_len = ip_header_len_field * 4
 
-        # 4. Parse the outermost ICMP header which is 8 bytes long:
+        # Discard replies too short to hold an ICMP header, and those that
+        # were corrupted in transit
+        if len(trReplyPacket) < ip_header_len + _ICMP_HDR.size:
+            return None, None
+        if not self.verifyIcmpChecksum(trReplyPacket, ip_header_len):
+            return None, None
+
+        # 3. Parse the outermost ICMP header which is 8 bytes long:
         # 0         8           16         24          32 bits
         #     Type  |    Code   |       Checksum       |
         #     Packet Identifier |       Sequence num   |
         # This header contains type, Code and Checksum + 4 bytes of padding (0's)
         # We only care about type field
-        icmpType, _, _, _, _ = struct.unpack(
-            "!BBHHH", trReplyPacket[ip_header_len : ip_header_len + 8]
-        )
+        icmpType = trReplyPacket[ip_header_len]
 
-        # 5. Parse the ICMP message if it has the expected type
-        if icmpType == 3 or icmpType == 11:
-            ip_header_inner = struct.unpack(
-                "!BBHHHBBH4s4s", trReplyPacket[ip_header_len + 8 : ip_header_len + 28]
-            )
+        # Destination port of the probe the reply answers, if any
+        dst_port = None
 
+        # 4. Parse the ICMP message if it has the expected type
+        if icmpType == 3 or icmpType == 11:
             # This is the original IP header sent in the probe packet
             # It should be 20 bytes, but let's not assume anything and extract the length
             # of the header
-            ip_header_len_field = ip_header_inner[0] & 0x0F
+            inner_ip = ip_header_len + _ICMP_HDR.size
+            if len(trReplyPacket) < inner_ip + _IP_HDR.size:
+                return None, None
+            ip_header_len_field = trReplyPacket[inner_ip] & 0x0F
             ip_header_inner_len = ip_header_len_field * 4
-
-            # Extract the destination port and match using source port (UDP)
-            _, dst_port, _, _ = struct.unpack(
-                "!HHHH",
-                trReplyPacket[
-                    ip_header_len
-                    + 8
-                    + ip_header_inner_len : ip_header_len
-                    + 8
-                    + ip_header_inner_len
-                    + 8
-                ],
-            )
+            inner_udp = inner_ip + ip_header_inner_len
+            if len(trReplyPacket) < inner_udp + _UDP_HDR.size:
+                return None, None
+
+            # Extract the destination port, and check the source port (UDP) so
+            # that replies to other programs' UDP packets are not matched
+            src_port, dst_port, _, _ = _UDP_HDR.unpack_from(trReplyPacket, inner_udp)
+            if (
+                trReplyPacket[inner_ip + 9] != socket.IPPROTO_UDP
+                or src_port != self.udpPort
+            ):
+                dst_port = None
 
         return dst_port, icmpType
 
     # Parse the response to the ICMP probe
     def parseICMPTracerouteResponse(self, trReplyPacket):
+        # An empty read holds no IP header to parse
+        if not trReplyPacket:
+            return None, None
 
-        # 1. Extract the first 20 bytes
-        ip_header = struct.unpack("!BBHHHBBH4s4s", trReplyPacket[:20])
+        # 1. Read the IP Header Length from the first byte of the IP header
+        # (using bit masking)
+        ip_header_len_field = trReplyPacket[0] & 0x0F
 
-        # 2. Read the IP Header Length (using bit masking)
-        ip_header_len_field = ip_header[0] & 0x0F
-
-        # 3. Compute the IP header length
+        # 2. Compute the IP header length
         ip_header_len = ip_header_len_field * 4
 
-        # 4. Parse the outermost ICMP header which is 8 bytes long:
-        icmpType, _, _, _, _ = struct.unpack(
-            "!BBHHH", trReplyPacket[ip_header_len : ip_header_len + 8]
+        # Discard replies too short to hold an ICMP header, and those that
+        # were corrupted in transit
+        if len(trReplyPacket) < ip_header_len + _ICMP_HDR.size:
+            return None, None
+        if not self.verifyIcmpChecksum(trReplyPacket, ip_header_len):
+            return None, None
+
+        # 3. Parse the outermost ICMP header which is 8 bytes long:
+        icmpType, _, _, packetID, sequenceNum = _ICMP_HDR.unpack_from(
+            trReplyPacket, ip_header_len
         )
 
-        return icmpType
+        # 4. An echo reply carries the probe's identifier and sequence number
+        # itself; time exceeded and unreachable messages embed the original IP
+        # header and the first 8 bytes of the probe, i.e. its ICMP header
+        if icmpType == 3 or icmpType == 11:
+            # Replies too short to hold both embedded headers are discarded
+            inner_ip = ip_header_len + _ICMP_HDR.size
+            if len(trReplyPacket) < inner_ip + _IP_HDR.size:
+                return None, None
+            if trReplyPacket[inner_ip + 9] != socket.IPPROTO_ICMP:
+                return None, icmpType
+            ip_header_inner_len = (trReplyPacket[inner_ip] & 0x0F) * 4
+            inner_icmp = inner_ip + ip_header_inner_len
+            if len(trReplyPacket) < inner_icmp + _ICMP_HDR.size:
+                return None, None
+            _, _, _, packetID, sequenceNum = _ICMP_HDR.unpack_from(
+                trReplyPacket, inner_icmp
+            )
+        elif icmpType != 0:
+            return None, icmpType
+
+        # 5. Only match probes sent with our identifier, not other pings
+        if packetID != self.packetID:
+            return None, icmpType
+
+        return sequenceNum, icmpType
 
     def receiveOneTraceRouteResponse(self):
 
@@ -646,12 +1370,14 @@ class Traceroute(ICMPPing):
 
         # 1. Receive one packet or timeout
         try:
-            pkt, addr = self.icmpSocket.recvfrom(MAX_DATA_RECV)
+            nbytes, addr = self.icmpSocket.recvfrom_into(self._rxbuf)
+            pkt = self._rxview[:nbytes]
             timeReceipt = time.time()
             hopAddr = addr[0]
 
-        # 2. Handler for timeout on receive
-        except socket.timeout as e:
+        # 2. Handler for timeout on receive (or, for a non-blocking socket,
+        # nothing left to receive)
+        except (socket.timeout, BlockingIOError) as e:
             timeReceipt = None
 
         # 3. Return the packet, hop address and the time of receipt
@@ -659,25 +1385,22 @@ class Traceroute(ICMPPing):
 
     def sendOneUdpProbe(self, destAddress, port, ttl, dataLength):
 
-        # 1. Create a UDP socket
-        udpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, UDP_CODE)
+        # 1. Use a socket option to set the TTL in the IP header
+        # (the UDP socket is created once and reused for every probe)
+        self.udpSocket.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
 
-        # 2. Use a socket option to set the TTL in the IP header
-        udpSocket.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
+        # 2. Send the UDP traceroute probe
+        self.udpSocket.sendto(_payload(dataLength, b"0"), (destAddress, port))
 
-        # 3. Send the UDP traceroute probe
-        udpSocket.sendto(str.encode(dataLength * "0"), (destAddress, port))
-
-        # 4. Record the time of sending
+        # 3. Record the time of sending
         timeSent = time.time()
 
-        # 5. Close the UDP socket
-        udpSocket.close()
-
         return timeSent
 
 
-# TODO: A multi-threaded traceroute implementation
+# A concurrent traceroute implementation: probes are sent and replies are
+# received by two tasks sharing one asyncio event loop (and one ICMP socket),
+# so no threads or locks are needed
 class MultiThreadedTraceRoute(Traceroute):
 
     def __init__(self, args):
@@ -685,21 +1408,19 @@ class MultiThreadedTraceRoute(Traceroute):
         # 1. Initialise instance variables (add others if needed)
         args.protocol = args.protocol.lower()
         self.timeout = args.timeout
-        self.send_complete = threading.Event()
+        self.send_complete = False
         self.packetID = random.randint(1, 65535)
         self.isDestinationReached = False
+        self.destinationTtl = None
         self.probes_sent = {}
+        self.probe_ttls = {}
         self.rtt_received = {}
         self.hop_addresses = {}
-        self.ttl_queue = []
-
-        # NOTE you must use a lock when accessing data shared between the two threads
-        self.lock = threading.Lock()
 
         # Look up hostname, resolving it to an IP address
         self.dstAddress = None
         try:
-            self.dstAddress = socket.gethostbyname(args.hostname)
+            self.dstAddress = _resolve_host(args.hostname)
             # socket.getaddrinfo(args.hostname, None, socket.AF_INET6)
         except socket.gaierror:
             print("Invalid hostname: ", args.hostname)
@@ -719,126 +1440,107 @@ class MultiThreadedTraceRoute(Traceroute):
             traceback.print_exception(err)
             exit(1)
 
-        # Set a timeout on the socket
-        self.icmpSocket.settimeout(args.timeout)
-
-        # 2. Create a thread to send probes
-        self.send_thread = threading.Thread(target=self.send_probes)
+        # The event loop waits for replies, so the socket never blocks
+        self.icmpSocket.setblocking(False)
 
-        # 3. Create a thread to receive responses
-        self.recv_thread = threading.Thread(target=self.receive_responses)
+        # Allocate the buffer that every reply is received into
+        self._rxbuf = bytearray(MAX_DATA_RECV)
+        self._rxview = memoryview(self._rxbuf)
 
-        # 4. Start the threads
-        self.send_thread.start()
-        self.recv_thread.start()
+        # Create the UDP socket used to send every UDP probe
+        self.udpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, UDP_CODE)
+        self.udpSocket.bind(("", 0))
+        self.udpPort = self.udpSocket.getsockname()[1]
 
-        # 5. Wait until both threads are finished executing
-        self.send_thread.join()
-        self.recv_thread.join()
+        # 2. Run the sending and receiving tasks until both are finished
+        asyncio.run(self.run_tasks())
 
-        # 6. Print results
+        # 3. Print results
+        self.printTracerouteResults(self.tracerouteRows(), args.hostname)
 
-        for ttl in self.rtt_received.keys():
+        # 4. Close ICMP and UDP sockets
+        self.icmpSocket.close()
+        self.udpSocket.close()
 
-            self.printMultipleResults(
-                ttl,
-                list(self.probes_sent[ttl].keys()),
-                self.hop_addresses[ttl],
-                self.rtt_received[ttl],
-                args.hostname,
-            )
+    async def run_tasks(self):
 
-        # 7. Close ICMP socket
-        self.icmpSocket.close()
+        # Wake the receiving task whenever the ICMP socket becomes readable
+        loop = asyncio.get_running_loop()
+        self.reply_ready = asyncio.Event()
+        loop.add_reader(self.icmpSocket, self.reply_ready.set)
+        try:
+            await asyncio.gather(self.send_probes(), self.receive_responses())
+        finally:
+            loop.remove_reader(self.icmpSocket)
 
-    # Thread to send probes (to be implemented, a skeleton is provided)
-    def send_probes(self):
+    # Task to send probes
+    async def send_probes(self):
 
         ttl = 1
 
-        while ttl <= MAX_TTL:
+        while ttl <= MAX_TTL and self.isDestinationReached == False:
             # Send three probes per TTL
-            for seq_num in range(3):
+            for probe in range(3):
+                self.sendTracerouteProbe(ttl, probe)
 
-                if args.protocol == "icmp":
-                    packetID = self.packetID
-                    timeSent = self.sendOnePing(
-                        self.dstAddress, packetID, seq_num, ttl, 0
-                    )
-
-                with self.lock:
-                    self.ttl_queue.append([ttl, seq_num])
-                    if ttl not in self.probes_sent:
-                        self.probes_sent[ttl] = {}
-
-                    self.probes_sent[ttl][seq_num] = timeSent
+                # Sleep for a short period between sending probes, letting the
+                # receiving task run
+                await asyncio.sleep(0.05)  # Small delay between probes
 
-                # Sleep for a short period between sending probes
-                time.sleep(0.05)  # Small delay between probes
-            with self.lock:
+            ttl += 1
 
-                if self.isDestinationReached == True:
+        # Wait for the last replies before notifying the receiving task to exit,
+        # stopping early once every probe up to the destination is answered
+        deadline = time.time() + args.timeout
+        while not self.isTracerouteComplete() and time.time() < deadline:
+            await asyncio.sleep(0.05)
+        self.send_complete = True
+        self.reply_ready.set()
+
+    # Task to receive responses
+    async def receive_responses(self):
+
+        # Keep receiving responses until notified by the other task
+        while not self.send_complete:
+            # Wait until a reply is ready (or sending is complete)
+            await self.reply_ready.wait()
+            self.reply_ready.clear()
+
+            # Receive every reply queued on the socket, matching each one to
+            # the probe it answers by its key rather than by arrival order
+            while True:
+                trReplyPacket, hopAddr, timeRecvd = self.receiveOneTraceRouteResponse()
+                if trReplyPacket is None:
                     break
+                self.recordTracerouteResponse(trReplyPacket, hopAddr, timeRecvd)
 
-            ttl += 1
 
-        # A final sleep before notifying the receive thread to exit
-        time.sleep(args.timeout)
-        # Notify the other thread that sending is complete
-        self.send_complete.set()
+# Memory maps of the files the web server has sent, with their response
+# headers, keyed by (path, modification time, size) so a changed file gets a
+# new entry. The least recently used maps are dropped beyond maxEntries, but
+# not closed: a worker may still be sending from one, and each is unmapped
+# once the last reference to it goes.
+class FileCache:
 
-    # Thread to receive responses (to be implemented, a skeleton is provided)
-    def receive_responses(self):
+    def __init__(self, maxEntries=WEB_CACHE_ENTRIES):
+        self.entries = OrderedDict()
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
 
-        ttl = None
-        seq_num = None
+    # Return the cached (header, map) entry for key, or None
+    def get(self, key: tuple) -> tuple[bytes, mmap.mmap] | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
 
-        # Keep receiving responses until notified by the other thread
-        while not self.send_complete.is_set():
-
-            if args.protocol == "icmp":
-                # print("receiving")
-                trReplyPacket, hopAddr, timeRecvd = self.receiveOneTraceRouteResponse()
-                # print("done")
-                if trReplyPacket is None:
-                    # print("packet empty")
-                    continue
-                # print("packet GOOD")
-                # Extract ICMP type and code from the reply
-                icmpType = self.parseICMPTracerouteResponse(trReplyPacket)
-                print("TTL")
-                print(ttl)
-                print("SN")
-                print(seq_num)
-
-            with self.lock:
-                current = self.ttl_queue.pop(0)
-                ttl = current[0]
-                seq_num = current[1]
-                # Check if we reached the destination
-                if self.dstAddress == hopAddr and icmpType == 0:
-                    self.isDestinationReached = True
-
-                if ttl not in self.rtt_received:
-                    self.rtt_received[ttl] = {}
-
-                if seq_num not in self.rtt_received[ttl]:
-                    self.rtt_received[ttl][seq_num] = None
-
-                if ttl not in self.hop_addresses:
-                    self.hop_addresses[ttl] = {}
-
-                if seq_num not in self.hop_addresses[ttl]:
-                    self.hop_addresses[ttl][seq_num] = None
-
-                if (
-                    timeRecvd
-                    and (ttl in self.probes_sent)
-                    and (seq_num in self.probes_sent[ttl])
-                ):
-                    rtt = timeRecvd - self.probes_sent[ttl][seq_num]
-                    self.rtt_received[ttl][seq_num] = rtt
-                    self.hop_addresses[ttl][seq_num] = hopAddr
+    def put(self, key: tuple, entry: tuple[bytes, mmap.mmap]) -> None:
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
 
 
 # A basic multi-threaded web server implementation
@@ -857,59 +1559,389 @@ class WebServer(NetworkApplication):
         # 1. Create a TCP socket
         serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+        self.configureListener(serverSocket)
+
         # 2. Bind the TCP socket to server address and server port
         serverSocket.bind(("", args.port))
 
         # 3. Continuously listen for connections to server socket
-        serverSocket.listen(100)
+        serverSocket.listen(socket.SOMAXCONN)
         print("Server listening on port", args.port)
 
-        while True:
-            # 4. Accept incoming connections
-            connectionSocket, addr = serverSocket.accept()
-            print(f"Connection established with {addr}")
+        # Keep recently sent files mapped into memory
+        self.fileCache: FileCache = FileCache()
 
-            # 5. Create a new thread to handle each client request
-            threading.Thread(
-                target=self.handleRequest, args=(connectionSocket,)
-            ).start()
+        # Handle requests on a fixed pool of worker threads
+        pool = ThreadPoolExecutor(max_workers=MAX_WEB_WORKERS, thread_name_prefix="web")
+
+        # 4. Accept incoming connections and 5. hand each client request to a
+        # worker thread once it arrives
+        self.serveConnections(serverSocket, pool, "Connection")
 
         # Close server socket (this would only happen if the loop was broken, which it isn't in this example)
         serverSocket.close()
 
-    def handleRequest(self, connectionSocket):
+    # Answer the requests on a connection, which stays open between requests
+    # if the client allows it
+    def handleRequest(self, connectionSocket: socket.socket, received: bytes) -> None:
+        keepAlive = False
         try:
-            # 1. Receive request message from the client
-            message = connectionSocket.recv(MAX_DATA_RECV).decode()
-
-            # 2. Extract the path of the requested object from the message (second part of the HTTP header)
-            filename = message.split()[1]
+            # Start from the bytes serveConnections has already received,
+            # which hold at least a whole header block
+            buffer, view = _recv_buffer()
+            filled = len(received)
+            buffer[:filled] = received
+            while True:
+                # 1. Receive request message from the client
+                message, filled = _receive_request(
+                    connectionSocket, buffer, view, filled
+                )
+                if message is None:
+                    keepAlive = False
+                    break
+                keepAlive = self.respond(connectionSocket, message)
+                keepAlive = keepAlive and _request_keeps_alive(message)
+
+                # Requests the client has already sent in full are answered
+                # straight away; otherwise the connection, with any part of
+                # its next request, waits in serveConnections rather than
+                # holding this worker
+                if not keepAlive or buffer.find(b"\r\n\r\n", 0, filled) < 0:
+                    break
 
-            # 3. Read the corresponding file from disk
-            with open(filename[1:], "r") as f:  # Skip the leading '/'
-                content = f.read()
+        except Exception as e:
+            keepAlive = False
+            print(f"Error handling request: {e}")
 
-            # 4. Create the HTTP response
-            response = "HTTP/1.1 200 OK\r\n\r\n"
-            response += content
+        finally:
+            if keepAlive:
+                self.returnConnection(connectionSocket, bytes(buffer[:filled]))
+            else:
+                # Close the connection socket
+                connectionSocket.close()
+
+    # Send the response to one request, returning whether the connection can
+    # be kept open afterwards
+    def respond(self, connectionSocket: socket.socket, message: bytes) -> bool:
+        # 2. Extract the path of the requested object from the message (second part of the HTTP header)
+        filename = _request_target(message)
+
+        # 3. Look up the corresponding file on disk. Regular files up to
+        # MAX_CACHED_FILE_SIZE are memory-mapped, with their response
+        # header, and reused for as long as the file is unchanged. Only
+        # failing to find or open the file is answered with a 404; errors
+        # sending the response reach handleRequest, which closes the
+        # connection
+        path = filename[1:].encode("latin-1")  # Skip the leading '/'
+        try:
+            fileStat = os.stat(path)
+            key = (path, fileStat.st_mtime_ns, fileStat.st_size)
+            entry = self.fileCache.get(key)
+            if (
+                entry is None
+                and stat.S_ISREG(fileStat.st_mode)
+                and 0 < fileStat.st_size <= MAX_CACHED_FILE_SIZE
+            ):
+                with open(path, "rb") as f:
+                    fileMap = mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ, **_MMAP_KWARGS
+                    )
+                header = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(fileMap)
+                entry = (header, fileMap)
+                self.fileCache.put(key, entry)
 
-            # 5. Send the content of the file to the socket
-            connectionSocket.send(response.encode())
+            # Otherwise open the file (in binary mode, so any kind of file can
+            # be served)
+            if entry is None:
+                f = open(path, "rb")
 
         except IOError:
-            # Handle file not found error
-            error_response = "HTTP/1.1 404 Not Found\r\n\r\n"
-            error_response += (
-                "<html><head></head><body><h1>404 Not Found</h1></body></html>\r\n"
+            # Handle file not found error (the response asks the client to
+            # close the connection)
+            connectionSocket.sendall(_NOT_FOUND_RESPONSE)
+            return False
+
+        # 4. and 5. Send the mapped file and its header in one write
+        if entry is not None:
+            _sendmsg_all(connectionSocket, entry)
+            return True
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+
+            # 4. Create the HTTP response header
+            header = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % size
+
+            # 5. Send the content of the file to the socket, copied by the
+            # kernel straight from the file where the platform supports
+            # it. Cork the socket so the header goes out in the same
+            # segment as the start of the file
+            cork = hasattr(socket, "TCP_CORK")
+            if cork:
+                connectionSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+            connectionSocket.sendall(header)
+            if size:
+                connectionSocket.sendfile(f, 0, size)
+            if cork:
+                connectionSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        return True
+
+
+# Byte translation table halving every counter in a sketch row at once
+_HALVE = bytes(i >> 1 for i in range(256))
+
+
+# Count-Min sketch of 4-bit counters estimating how often each key has been
+# requested recently, with a doorkeeper set that absorbs the first request for
+# a key so one-off requests take no counter space. Every `sampleSize`
+# increments all counters are halved (and the doorkeeper cleared), so the
+# estimates follow recent popularity rather than all-time totals.
+class CountMinSketch:
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.rows = [bytearray(width) for _ in range(depth)]
+        self.doorkeeper = set()
+        self.additions = 0
+        self.sampleSize = 10 * width
+
+    def increment(self, key: object) -> None:
+        if key not in self.doorkeeper:
+            self.doorkeeper.add(key)
+        else:
+            # Row i is indexed by a hash of (i, key), which behaves as an
+            # independent hash function per row
+            for i, row in enumerate(self.rows):
+                index = hash((i, key)) % self.width
+                if row[index] < 15:
+                    row[index] += 1
+
+        self.additions += 1
+        if self.additions >= self.sampleSize:
+            self.age()
+
+    def estimate(self, key: object) -> int:
+        count = min(row[hash((i, key)) % self.width] for i, row in enumerate(self.rows))
+        return count + 1 if key in self.doorkeeper else count
+
+    def age(self) -> None:
+        for row in self.rows:
+            row[:] = row.translate(_HALVE)
+        self.doorkeeper.clear()
+        self.additions //= 2
+
+
+# Cached response held in an anonymous memory file (memfd) rather than the
+# Python heap, so that hits are copied to the client by the kernel. Each hit
+# sends from its own duplicate of the file descriptor, which lets the cache
+# close the original on eviction while a hit is still being sent.
+class MemfdResponse:
+
+    # Memory files the cache may still create, out of MAX_MEMFD_RESPONSES
+    slots = threading.BoundedSemaphore(MAX_MEMFD_RESPONSES)
+
+    def __init__(self, fd: int, size: int, head: bytes):
+        self.fd = fd
+        self.size = size
+        # Header block of the response, to tell how the response is framed
+        self.head = head
+
+    # Copy a response into a new memory file
+    @classmethod
+    def fromBytes(cls, response: bytes) -> MemfdResponse:
+        fd = os.memfd_create("proxy-cache", os.MFD_CLOEXEC)
+        try:
+            view = memoryview(response)
+            while view:
+                view = view[os.write(fd, view) :]
+        except OSError:
+            os.close(fd)
+            raise
+        headerEnd = response.find(b"\r\n\r\n")
+        head = response[: headerEnd + 4] if headerEnd != -1 else response
+        return cls(fd, len(response), head)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def duplicate(self) -> MemfdResponse:
+        return MemfdResponse(os.dup(self.fd), self.size, self.head)
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    # Send the whole response to sock and close this descriptor. socket.sendfile
+    # waits for the socket to drain (it has a timeout, so is non-blocking)
+    # between os.sendfile calls
+    def sendTo(self, sock: socket.socket) -> None:
+        with os.fdopen(self.fd, "rb", buffering=0) as file:
+            sock.sendfile(file, 0, self.size)
+
+
+# Value stored in the proxy cache for an admitted response: a memory file when
+# the response is large enough and one is free, otherwise the bytes
+def _cache_value(response: bytes) -> bytes | MemfdResponse:
+    if len(response) < MIN_MEMFD_RESPONSE:
+        return response
+    if not MemfdResponse.slots.acquire(blocking=False):
+        return response
+    try:
+        return MemfdResponse.fromBytes(response)
+    except OSError:
+        MemfdResponse.slots.release()
+        return response
+
+
+# Value handed to a cache hit, which must not be closed by a later eviction
+def _checkout(value: bytes | MemfdResponse) -> bytes | MemfdResponse:
+    return value.duplicate() if isinstance(value, MemfdResponse) else value
+
+
+# Free a value that has left the cache
+def _discard(value: bytes | MemfdResponse) -> None:
+    if isinstance(value, MemfdResponse):
+        value.close()
+        MemfdResponse.slots.release()
+
+
+# Cache of proxied responses, bounded by entry count and total size.
+# Responses are split between a probation segment, where new responses start,
+# and a protected segment for responses requested again while cached (each in
+# least recently used order). When the cache is full a new response is only
+# admitted if it has been requested more often than every response it would
+# evict, so a burst of one-off requests cannot flush out the popular ones.
+class ProxyCache:
+
+    def __init__(
+        self,
+        maxEntries=PROXY_CACHE_ENTRIES,
+        maxBytes=PROXY_CACHE_BYTES,
+        sketchWidth=PROXY_SKETCH_WIDTH,
+    ):
+        # Both segments map keys to (response, expiry) entries
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.maxEntries = maxEntries
+        self.maxProtected = maxEntries * 4 // 5
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.sketch = CountMinSketch(width=sketchWidth)
+        self.lock = threading.Lock()
+
+    # Record a request for key and return its cached response (marking it
+    # most recently used), or None if it is not cached or has expired. A
+    # MemfdResponse returned is the caller's to close
+    def get(self, key: tuple) -> bytes | MemfdResponse | None:
+        with self.lock:
+            self.sketch.increment(key)
+
+            entry = self.protected.get(key)
+            if entry is not None:
+                if entry[1] <= time.monotonic():
+                    self.size -= len(self.protected.pop(key)[0])
+                    _discard(entry[0])
+                    return None
+                self.protected.move_to_end(key)
+                return _checkout(entry[0])
+
+            # A second request while on probation promotes the response,
+            # demoting the least recently used protected one if that is full
+            entry = self.probation.pop(key, None)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                self.size -= len(entry[0])
+                _discard(entry[0])
+                return None
+            self.protected[key] = entry
+            if len(self.protected) > self.maxProtected:
+                demotedKey, demoted = self.protected.popitem(last=False)
+                self.probation[demotedKey] = demoted
+            return _checkout(entry[0])
+
+    # Offer a response to the cache for ttl seconds, which admits it if there
+    # is room or if it is more popular than the responses that would be
+    # evicted to make room. Only an admitted response is copied into a memory
+    # file
+    def put(self, key: tuple, response: bytes, ttl: float) -> None:
+        # A response larger than the whole cache would only evict everything
+        if len(response) > self.maxBytes:
+            return
+
+        with self.lock:
+            # Replacing a cached response skips the admission check
+            refresh = False
+            for segment in (self.probation, self.protected):
+                old = segment.pop(key, None)
+                if old is not None:
+                    self.size -= len(old[0])
+                    _discard(old[0])
+                    refresh = True
+
+            # Pick victims from the probation segment first, then protected.
+            # Expiry is only checked on these, so a put stays O(victims)
+            now = time.monotonic()
+            spareBytes = self.maxBytes - self.size - len(response)
+            spareEntries = (
+                self.maxEntries - len(self.probation) - len(self.protected) - 1
+            )
+            victims = []
+            for segment in (self.probation, self.protected):
+                for victimKey, (victim, expiry) in segment.items():
+                    if spareBytes >= 0 and spareEntries >= 0:
+                        break
+                    victims.append((segment, victimKey, expiry <= now))
+                    spareBytes += len(victim)
+                    spareEntries += 1
+
+            # Expired victims are evicted whatever their popularity, so a
+            # stale response cannot keep a fresh one out of the cache
+            if victims and not refresh:
+                frequency = self.sketch.estimate(key)
+                for _, victimKey, expired in victims:
+                    if not expired and self.sketch.estimate(victimKey) >= frequency:
+                        return
+
+            for segment, victimKey, _ in victims:
+                victim = segment.pop(victimKey)[0]
+                self.size -= len(victim)
+                _discard(victim)
+
+            self.probation[key] = (_cache_value(response), now + ttl)
+            self.size += len(response)
+
+
+# Proxy cache split into independent ProxyCache shards, each with its own lock,
+# with keys assigned to shards by their hash so that requests for unrelated
+# URLs do not wait for each other. The entry and size limits (and sketch
+# width) are divided evenly between the shards, of which there are never more
+# than entries, so a small cache keeps exactly its entry limit.
+class ShardedProxyCache:
+
+    def __init__(
+        self,
+        maxEntries=PROXY_CACHE_ENTRIES,
+        maxBytes=PROXY_CACHE_BYTES,
+        shards=PROXY_CACHE_SHARDS,
+    ):
+        # Use the largest power of two no greater than either limit, and give
+        # the entries left over from an even split one each to the first shards
+        shards = 1 << (max(1, min(shards, maxEntries)).bit_length() - 1)
+        self.shards = [
+            ProxyCache(
+                maxEntries=maxEntries // shards + (i < maxEntries % shards),
+                maxBytes=maxBytes // shards,
+                sketchWidth=max(64, PROXY_SKETCH_WIDTH // shards),
             )
-            connectionSocket.send(error_response.encode())
+            for i in range(shards)
+        ]
+        self.mask = shards - 1
 
-        except Exception as e:
-            print(f"Error handling request: {e}")
+    def get(self, key: tuple) -> bytes | MemfdResponse | None:
+        return self.shards[hash(key) & self.mask].get(key)
 
-        finally:
-            # Close the connection socket
-            connectionSocket.close()
+    def put(self, key: tuple, response: bytes, ttl: float) -> None:
+        self.shards[hash(key) & self.mask].put(key, response, ttl)
 
 
 # TODO: A proxy implementation
@@ -918,97 +1950,257 @@ class Proxy(NetworkApplication):
     def __init__(self, args):
         print("Web Proxy starting on port: %i..." % (args.port))
 
-        # 1. Create cache to store responses
-        self.cache = {}
+        # 1. Create cache to store responses, and pools of idle keep-alive
+        # connections to web servers ({hostname: LifoQueue of sockets})
+        self.cache: ShardedProxyCache = ShardedProxyCache(maxEntries=args.cache_size)
+        self.serverPools: dict[str, queue.LifoQueue] = {}
 
         # 2. Create a TCP socket for the proxy server
         proxySocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+        self.configureListener(proxySocket)
+
         # 3. Bind the proxy server socket to the port given by user
         proxySocket.bind(("", args.port))
 
         # 4. Continuously listen for connections
-        proxySocket.listen(100)
+        proxySocket.listen(socket.SOMAXCONN)
         print(f"Proxy server listening on port {args.port}")
 
-        while True:
-            # 5. Accept incoming connections
-            connectionSocket, addr = proxySocket.accept()
-            print(f"Proxy connection established with {addr}")
+        # Handle requests on a fixed pool of worker threads
+        pool = ThreadPoolExecutor(
+            max_workers=MAX_PROXY_WORKERS, thread_name_prefix="proxy"
+        )
 
-            # 6. Create a new thread to handle each client request
-            threading.Thread(
-                target=self.handleRequest, args=(connectionSocket,)
-            ).start()
+        # 5. Accept incoming connections and 6. hand each client request to a
+        # worker thread once it arrives
+        self.serveConnections(proxySocket, pool, "Proxy connection")
 
         # Close proxy socket if the loop is ever broken
         proxySocket.close()
 
-    def handleRequest(self, connectionSocket):
+    # Answer the requests on a connection, which stays open between requests
+    # if the client allows it and each response marks its own end
+    def handleRequest(self, connectionSocket: socket.socket, received: bytes) -> None:
+        keepAlive = False
         try:
-            # 1. Receive request message from the client
-            message = connectionSocket.recv(MAX_DATA_RECV).decode()
+            # Start from the bytes serveConnections has already received,
+            # which hold at least a whole header block
+            buffer, view = _recv_buffer()
+            filled = len(received)
+            buffer[:filled] = received
+            while True:
+                # 1. Receive request message from the client
+                message, filled = _receive_request(
+                    connectionSocket, buffer, view, filled
+                )
+                if message is None:
+                    keepAlive = False
+                    break
+                keepAlive = self.respond(connectionSocket, message)
+                keepAlive = keepAlive and _request_keeps_alive(message)
+
+                # Requests the client has already sent in full are answered
+                # straight away; otherwise the connection, with any part of
+                # its next request, waits in serveConnections rather than
+                # holding this worker
+                if not keepAlive or buffer.find(b"\r\n\r\n", 0, filled) < 0:
+                    break
 
-            # 2. Extract the path of the requested object from the message (second part of the HTTP header)
-            filename = message.split()[1]
+        except Exception as e:
+            keepAlive = False
+            print(f"Error handling request: {e}")
 
-            # 3. Check the cache for object:
-            # Cache hit: Send to client / Cache miss: Request from server, cache response then send to client
-            if filename in self.cache:
-                print(f"Cache hit for {filename}")
-                response = self.cache[filename]
+        finally:
+            if keepAlive:
+                self.returnConnection(connectionSocket, bytes(buffer[:filled]))
             else:
-                print(f"Cache miss for {filename}, fetching from server")
-                # Create temporary buffer to store responses from server
-                buffer = []
-
-                # Get hostname from request message
-                hostname = None
-                lines = message.split("\r\n")
-                for line in lines:
-                    if line.startswith("Host:"):
-                        hostname = line.split()[1]
-                        break
-                if hostname == None:
-                    raise ValueError("Host header not found in request")
-
-                # Connect to server, send request and set socket timeout
-                serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                serverSocket.connect((hostname, 80))
-                serverSocket.send(message.encode())
-                serverSocket.settimeout(5)
-
-                # Receive response from the server
+                # Close the connection socket with client
+                connectionSocket.close()
+
+    # Send the response to one request, from the cache or the web server,
+    # returning whether the connection can be kept open afterwards
+    def respond(self, connectionSocket: socket.socket, message: bytes) -> bool:
+        # 2. Extract the path of the requested object from the message (second part of the HTTP header)
+        filename = _request_target(message)
+
+        # Get hostname from request message
+        hostname = _request_host(message)
+        if hostname == None:
+            raise ValueError("Host header not found in request")
+
+        # 3. Check the cache for object (only GET requests are answered from
+        # and stored in it):
+        # Cache hit: Send to client / Cache miss: Request from server, cache response then send to client
+        key = _cache_key(hostname, filename)
+        cacheable = message.startswith(b"GET ")
+        authorized = (
+            _header_value(
+                message[: message.find(b"\r\n\r\n")].lower(), b"authorization"
+            )
+            is not None
+        )
+        response = self.cache.get(key) if cacheable else None
+        if response is not None:
+            print(f"Cache hit for {filename}")
+
+            # Send the content of the file to the client socket, all of it
+            # (send may stop short), by sendfile from a cached memory file or
+            # straight from the shared cached bytes
+            if isinstance(response, MemfdResponse):
+                response.sendTo(connectionSocket)
+                return _response_delimited(response.head, False)
+            connectionSocket.sendall(memoryview(response))
+            return _response_delimited(response, False)
+
+        print(f"Cache miss for {filename}, fetching from server")
+        # Ask the server to keep the connection open for later misses
+        request = _keep_alive_request(message)
+        isHead = message.startswith(b"HEAD ")
+
+        # Connect to server (reusing an idle connection if there is one), send
+        # request and relay the response to the client. The server may have
+        # closed an idle connection in the meantime, in which case nothing
+        # comes back and the request is retried on a new one. Only idempotent
+        # requests may be sent twice, so others always get a new connection
+        idempotent = message.startswith(_IDEMPOTENT_METHODS)
+        while True:
+            serverSocket, reused = self.connectToServer(hostname, idempotent)
+            try:
                 try:
-                    while True:
-                        response_received = serverSocket.recv(4096)
-
-                        if not response_received:
-                            break
-
-                        buffer.append(response_received)
-
-                except socket.timeout:
-                    print("TimeoutError")
-                    pass
-
-                response = b"".join(buffer)
+                    serverSocket.sendall(request)
+                except ConnectionError:
+                    if not reused:
+                        raise
+                    serverSocket.close()
+                    continue
+                # Errors once relaying has started (from either socket) are
+                # not retried, as part of the response may have been sent
+                response, complete, reusable = self.relayResponse(
+                    serverSocket, connectionSocket, isHead
+                )
+            except Exception:
+                serverSocket.close()
+                raise
 
-                # Cache the response
-                self.cache[filename] = response
+            if response or not reused:
+                break
+            serverSocket.close()
 
-                # Close the connection socket with server
-                serverSocket.close()
+        # Return the connection to the pool if the response was read exactly
+        # to its end, otherwise close it
+        if reusable:
+            self.releaseServerConnection(hostname, serverSocket)
+        else:
+            serverSocket.close()
+
+        # Cache the response for as long as it stays fresh
+        ttl = _response_ttl(response, authorized) if complete and cacheable else 0
+        if ttl > 0:
+            self.cache.put(key, response, ttl)
+
+        return complete and _response_delimited(response, isHead)
+
+    # Return a connection to the web server hostname, and whether it is an
+    # idle pooled connection rather than a new one (never, unless reuse)
+    def connectToServer(
+        self, hostname: str, reuse: bool = True
+    ) -> tuple[socket.socket, bool]:
+        if reuse:
+            try:
+                return self.serverPools[hostname].get_nowait(), True
+            except (KeyError, queue.Empty):
+                pass
+        serverSocket = socket.create_connection((hostname, 80))
+        serverSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        serverSocket.settimeout(5)
+        return serverSocket, False
+
+    # Keep an idle connection to hostname for reuse, or close it if the pool
+    # for that server is full
+    def releaseServerConnection(
+        self, hostname: str, serverSocket: socket.socket
+    ) -> None:
+        pool = self.serverPools.get(hostname)
+        if pool is None:
+            pool = self.serverPools.setdefault(
+                hostname, queue.LifoQueue(maxsize=MAX_SERVER_CONNECTIONS)
+            )
+        try:
+            pool.put_nowait(serverSocket)
+        except queue.Full:
+            serverSocket.close()
+
+    # Receive the response to a request from the server into a pooled buffer,
+    # relaying each chunk to the client as soon as it arrives. Returns the
+    # response, whether it arrived complete, and whether the connection to the
+    # server can be reused (the response was delimited by its framing and
+    # nothing followed it)
+    def relayResponse(
+        self, serverSocket: socket.socket, connectionSocket: socket.socket, isHead: bool
+    ) -> tuple[bytes, bool, bool]:
+        buffer = bytearray()
+        headerEnd = -1
+        end = None
+        chunked = False
+        chunkPos = 0
+        keepAlive = False
+
+        # A reused connection has left the kernel's quick-ACK mode, so delayed
+        # ACKs would stall a server that waits for one before sending the rest
+        # of its response (Nagle); ask for immediate ACKs before every read
+        quickAck = hasattr(socket, "TCP_QUICKACK")
+
+        chunk = _acquire_chunk()
+        try:
+            while end is None or len(buffer) < end:
+                if quickAck:
+                    serverSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+                try:
+                    received = serverSocket.recv_into(chunk)
+                except ConnectionError:
+                    # A reset before any of the response counts as the server
+                    # having closed the connection
+                    if buffer:
+                        raise
+                    received = 0
+
+                # The server closing the connection only completes a response
+                # that has no length
+                if not received:
+                    complete = headerEnd >= 0 and end is None and not chunked
+                    return bytes(buffer), complete, False
+
+                connectionSocket.sendall(chunk[:received])
+                buffer += chunk[:received]
+
+                # Work out how the body is delimited once the header is in,
+                # searching only from just before the newly received bytes
+                if headerEnd < 0:
+                    headerEnd = buffer.find(
+                        b"\r\n\r\n", max(0, len(buffer) - received - 3)
+                    )
+                    if headerEnd < 0:
+                        continue
+                    headerEnd += 4
+                    length, chunked, keepAlive = _response_framing(
+                        buffer[:headerEnd], isHead
+                    )
+                    if length is not None:
+                        end = headerEnd + length
+                    chunkPos = headerEnd
 
-            # Send the content of the file to the client socket
-            connectionSocket.send(response)  # .encode()?
+                if chunked:
+                    end, chunkPos = _chunked_end(buffer, chunkPos)
 
-        except Exception as e:
-            print(f"Error handling request: {e}")
+        except socket.timeout:
+            print("TimeoutError")
+            return bytes(buffer), False, False
 
         finally:
-            # Close the connection socket with client
-            connectionSocket.close()
+            _release_chunk(chunk)
+
+        return bytes(buffer), True, keepAlive and len(buffer) == end
 
 
 # NOTE: Do NOT delete the code below